@@ -68,7 +68,7 @@ class BetaSchedule:
         
         return model_eps, model_mean, model_var
         
-    @torch.no_grad()
+    @torch.inference_mode()
     def sample(self, a: "N,A,L", t: "N,T,L", x: "N,X,L" = None, *, ddim=False) -> "N,X,L":
         """sample p(x)"""
         
@@ -150,6 +150,7 @@ class Data(pl.LightningDataModule):
         src_path: str = None,
         val_split: float = None,
         val_size: int = None,
+        samples_per_epoch: int = None,
     ):
         super().__init__()
         
@@ -164,6 +165,7 @@ class Data(pl.LightningDataModule):
             raise ValueError('exactly one of `val_split` or `val_size` must be specified')
         self.val_split = val_split
         self.val_size = val_size
+        self.samples_per_epoch = samples_per_epoch
         
         self.data_dir = Path(data_path)
         try:
@@ -208,6 +210,24 @@ class Data(pl.LightningDataModule):
         if val_size > len(full_set):
             raise ValueError(f"`val_size` ({val_size}) is greater than the number of samples ({len(full_set)})")
             
+        # read from the trainer here rather than from `torch.distributed` in the dataloader workers,
+        # which don't see the process group when they are spawned (the default on windows and macos)
+        if self.trainer is not None:
+            world_size = self.trainer.world_size
+            rank = self.trainer.global_rank
+        else:
+            world_size = 1
+            rank = 0
+            
+        if self.samples_per_epoch is None and world_size > 1:
+            # every rank must run the same number of training steps, otherwise ranks that
+            # finish early stop joining the gradient sync and the others hang
+            raise ValueError("`samples_per_epoch` must be specified when training on multiple devices")
+            
+        if world_size > 1 and val_size < world_size * max(1, self.num_workers):
+            # validation metrics are synced across ranks, so every rank (and worker) needs at least one map
+            raise ValueError(f"`val_size` ({val_size}) must be at least `num_workers` * the number of devices ({world_size * max(1, self.num_workers)}) when training on multiple devices")
+            
         train_size = len(full_set) - val_size
         print(f'train: {train_size} | val: {val_size}')
         train_split, val_split = random_split(full_set, [train_size, val_size])
@@ -217,8 +237,15 @@ class Data(pl.LightningDataModule):
             seq_len=self.seq_len,
             sample_density=self.sample_density,
             subseq_density=self.subseq_density,
+            num_samples=self.samples_per_epoch,
+            rank=rank,
+            world_size=world_size,
+        )
+        self.val_set = FullSequenceDataset(
+            dataset=val_split,
+            rank=rank,
+            world_size=world_size,
         )
-        self.val_set = FullSequenceDataset(dataset=val_split)
             
     def train_dataloader(self):
         return DataLoader(
@@ -240,6 +267,9 @@ class StreamPerSample(IterableDataset):
         super().__init__()
         self.dataset = kwargs.pop("dataset")
         self.sample_density = kwargs.pop("sample_density", 1.)
+        self.num_samples = kwargs.pop("num_samples", None)
+        self.rank = kwargs.pop("rank", 0)
+        self.world_size = kwargs.pop("world_size", 1)
         
         if not 0 < self.sample_density <= 1:
             raise ValueError("sample density must be in (0, 1]:", self.sample_density)
@@ -259,12 +289,36 @@ class StreamPerSample(IterableDataset):
             num_workers = worker_info.num_workers
             worker_id = worker_info.id
             seed = worker_info.seed
+            
+        # split workload across ranks as well as workers
+        num_shards = num_workers * self.world_size
+        shard_id = self.rank * num_workers + worker_id
         
         random.seed(seed)
         
+        if self.num_samples is None:
+            yield from self.shard_stream(num_shards, shard_id)
+            return
+            
+        # yield exactly the same number of samples from every shard (cycling through the
+        # shard's maps as needed), so that every rank gets the same number of batches
+        num_samples = self.num_samples // num_shards
+        while num_samples > 0:
+            shard_empty = True
+            for x in self.shard_stream(num_shards, shard_id):
+                shard_empty = False
+                yield x
+                num_samples -= 1
+                if num_samples == 0:
+                    return
+                    
+            if shard_empty:
+                raise RuntimeError(f"shard {shard_id}/{num_shards} has no samples")
+                
+    def shard_stream(self, num_shards, shard_id):
         dataset = sorted(self.dataset)
         for i, sample in random.sample(list(enumerate(dataset)), int(len(dataset) * self.sample_density)):
-            if i % num_workers != worker_id:
+            if i % num_shards != shard_id:
                 continue
                 
             try:
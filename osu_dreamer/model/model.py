@@ -1,15 +1,16 @@
 from typing import List, Tuple
 
-import copy
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-import librosa
 
 import torch
 import torch.nn.functional as F
 
 try:
-    import matplotlib.pyplot as plt
+    from matplotlib import rcParams
+    from matplotlib.figure import Figure
+    from matplotlib.collections import LineCollection
     USE_MATPLOTLIB = True
 except:
     USE_MATPLOTLIB = False
@@ -38,6 +39,7 @@ class Model(pl.LightningModule):
         timing_dropout: float,
         learning_rate: float = 0.,
         learning_rate_schedule_factor: float = 0.,
+        compile_net: bool = False,
     ):
         super().__init__()
         self.save_hyperparameters()
@@ -53,6 +55,20 @@ class Model(pl.LightningModule):
         self.schedule = CosineBetaSchedule(timesteps, self.net)
         self.sampling_schedule = StridedBetaSchedule(self.schedule, sample_steps, self.net)
         
+        # compiled UNet forward, used for training steps (whose shape is fixed by `seq_len`) and for sampling
+        # (where every step of a `sample` call shares one padded shape, so each song costs a single
+        # CUDA graph recording that is replayed for all steps). validation sees a different length for
+        # every map and stays uncompiled.
+        # compiling the bound method keeps it from being registered as a submodule,
+        # so checkpoints keep the plain UNet's parameter names
+        self.compiled_net = None
+        self.compiled_sampling_schedule = None
+        if compile_net:
+            if not hasattr(torch, "compile"):
+                raise NotImplementedError("`compile_net` requires torch>=2.0")
+            self.compiled_net = torch.compile(self.net.forward, mode="reduce-overhead")
+            self.compiled_sampling_schedule = StridedBetaSchedule(self.schedule, sample_steps, self.compiled_net)
+        
         # training params
         try:
             self.loss_fn = dict(
@@ -68,16 +84,36 @@ class Model(pl.LightningModule):
         self.timing_dropout = timing_dropout
         self.depth = len(dim_mults)
         
-    def inference_pad(self, x):
-        x = F.pad(x, (VALID_PAD, VALID_PAD), mode='replicate')
-        pad = (1 + x.size(-1) // 2 ** self.depth) * 2 ** self.depth - x.size(-1)
-        x = F.pad(x, (0, pad), mode='replicate')
-        return x, (..., slice(VALID_PAD,-(VALID_PAD+pad)))
+        # scratch buffer for the noise added in `compute_loss` during training, refilled every step
+        self.eps_buf = None
+        
+        # validation plots are rendered off the training thread (see `validation_epoch_end`)
+        self.plot_executor = None
+        self.plot_future = None
+        
+    def pad_amount(self, L):
+        """returns the padding before and after a length `L` sequence, and the slice that undoes it"""
+        pad = (1 + (L + 2 * VALID_PAD) // 2 ** self.depth) * 2 ** self.depth - (L + 2 * VALID_PAD)
+        return VALID_PAD, VALID_PAD + pad, (..., slice(VALID_PAD,-(VALID_PAD+pad)))
+        
+    def inference_pad(self, *xs):
+        """pads tensors of the same length together, returns the padded tensors and the slice that undoes the padding"""
+        pre, post, sl = self.pad_amount(xs[0].size(-1))
+        x = torch.cat(xs, dim=1)
+        x = F.pad(x, (pre, post), mode='replicate')
+        return x.split([ y.size(1) for y in xs ], dim=1), sl
         
-    def forward(self, a: "N,A,L", t: "N,T,L", **kwargs):
-        a, sl = self.inference_pad(a)
-        t, _  = self.inference_pad(t)
-        return self.sampling_schedule.sample(a, t, **kwargs)[sl]
+    def forward(self, a: "N,A,L", t: "N,T,L", compiled=True, **kwargs):
+        """
+        `a` and `t` may be non-contiguous (eg. broadcast with `expand`) -
+        padding copies them into a fresh tensor before they reach the network.
+        samples with the compiled network when `compile_net` is set, unless `compiled=False`
+        """
+        (a, t), sl = self.inference_pad(a, t)
+        schedule = self.sampling_schedule
+        if compiled and self.compiled_sampling_schedule is not None:
+            schedule = self.compiled_sampling_schedule
+        return schedule.sample(a, t, **kwargs)[sl]
     
     
 #
@@ -89,23 +125,28 @@ class Model(pl.LightningModule):
 #
 
     def compute_loss(self, a, t, p, x, pad=False, timing_dropout=0.):
-        ts = torch.randint(0, self.schedule.timesteps, (x.size(0),), device=x.device).long()
+        ts = torch.randint(0, self.schedule.timesteps, (x.size(0),), device=x.device, dtype=torch.long)
         
         if pad:
-            a, _ = self.inference_pad(a)
-            t, _ = self.inference_pad(t)
-            p, _ = self.inference_pad(p)
-            x, _ = self.inference_pad(x)
+            (a, t, p, x), _ = self.inference_pad(a, t, p, x)
             
         if timing_dropout > 0:
-            drop_idxs = torch.randperm(t.size(0))[:int(t.size(0) * timing_dropout)]
-            t[drop_idxs] = p[drop_idxs]
+            # out-of-place so the caller's batch is left untouched
+            drop_mask = torch.rand(t.size(0), device=t.device) < timing_dropout
+            t = torch.where(drop_mask[:,None,None], p, t)
         
-        true_eps: "N,X,L" = torch.randn_like(x)
+        if pad:
+            # padded (validation) sequences differ in length every call, so don't keep them around
+            true_eps: "N,X,L" = torch.randn_like(x)
+        else:
+            if self.eps_buf is None or self.eps_buf.shape != x.shape or self.eps_buf.device != x.device:
+                self.eps_buf = torch.empty_like(x)
+            true_eps: "N,X,L" = self.eps_buf.normal_()
 
         x_t: "N,X,L" = self.schedule.q_sample(x, ts, true_eps)
         
-        pred_eps = self.net(x_t, a, t, ts)
+        net = self.net if pad or self.compiled_net is None else self.compiled_net
+        pred_eps = net(x_t, a, t, ts)
         
         return self.loss_fn(true_eps, pred_eps).mean()
 
@@ -122,8 +163,7 @@ class Model(pl.LightningModule):
         )
     
     def training_step(self, batch: Tuple["N,A,L", "N,T,L", "N,T,L", "N,X,L"], batch_idx):
-        torch.cuda.empty_cache()
-        a,t,p,x = copy.deepcopy(batch)
+        a,t,p,x = batch
         
         loss = self.compute_loss(a,t,p,x,timing_dropout=self.timing_dropout)
         
@@ -135,20 +175,19 @@ class Model(pl.LightningModule):
         return loss
 
     def validation_step(self, batch: Tuple["1,A,L","1,T,L","1,T,L","1,X,L"], batch_idx, *args, **kwargs):
-        torch.cuda.empty_cache()
-        a,t,p,x = copy.deepcopy(batch)
+        a,t,p,x = batch
         
-        loss = self.compute_loss(a,t,p,x, pad=True, timing_dropout=self.timing_dropout)
+        loss = self.compute_loss(a,t,p,x, pad=True)
         dropout_loss = self.compute_loss(a,t,p,x, pad=True, timing_dropout=1.)
         
         self.log(
             "val/loss", loss.detach(),
-            logger=True, on_step=False, on_epoch=True,
+            logger=True, on_step=False, on_epoch=True, sync_dist=True,
         )
         
         self.log(
             "val/dropout_loss", dropout_loss.detach(),
-            logger=True, on_step=False, on_epoch=True,
+            logger=True, on_step=False, on_epoch=True, sync_dist=True,
         )
         
         return a,t,p,x
@@ -157,21 +196,35 @@ class Model(pl.LightningModule):
         if not USE_MATPLOTLIB or len(val_outs) == 0:
             return
         
-        torch.cuda.empty_cache()
-        a,t,p,x = copy.deepcopy(val_outs[0])
+        a,t,p,x = val_outs[0]
         
-        samples = self(a.repeat(2,1,1), torch.cat([ t,p ], dim=0) ).cpu().numpy()
+        # the plotted map changes every epoch, so don't record a new CUDA graph for each one
+        samples = self(a.expand(2,-1,-1), torch.cat([ t,p ], dim=0), compiled=False).cpu().numpy()
         
         a: "A,L" = a.squeeze(0).cpu().numpy()
         x: "X,L" = x.squeeze(0).cpu().numpy()
         
+        # render and log the figure in the background so training can resume immediately,
+        # keeping at most one plot in flight (and surfacing any error from the last one)
+        if self.plot_executor is None:
+            self.plot_executor = ThreadPoolExecutor(max_workers=1)
+        if self.plot_future is not None:
+            self.plot_future.result()
+        self.plot_future = self.plot_executor.submit(self.plot_samples, a, x, samples, self.global_step)
+        
+    def on_fit_end(self):
+        if self.plot_future is not None:
+            self.plot_future.result()
+        
+    def plot_samples(self, a: "A,L", x: "X,L", samples: "2,X,L", global_step: int):
         height_ratios = [1.5] + [1] * (1+len(samples))
         w, h = a.shape[-1]/150, sum(height_ratios)/2
         margin, margin_left = .1, .5
         
-        fig, (ax1, *axs) = plt.subplots(
+        # `Figure` rather than `pyplot`, which is not safe to use outside the main thread
+        fig = Figure(figsize=(w, h))
+        ax1, *axs = fig.subplots(
             len(height_ratios), 1,
-            figsize=(w, h),
             sharex=True,
             gridspec_kw=dict(
                 height_ratios=height_ratios,
@@ -183,7 +236,9 @@ class Model(pl.LightningModule):
             )
         )
         
-        ax1.imshow(librosa.power_to_db(a), origin="lower", aspect='auto')
+        # equivalent to `librosa.power_to_db(a)`
+        a_db = 10 * np.log10(np.maximum(a, 1e-10))
+        ax1.imshow(np.maximum(a_db, a_db.max() - 80.), origin="lower", aspect='auto')
         
         for sample, ax in zip((x, *samples), axs):
             mu = np.mean(sample)
@@ -191,8 +246,11 @@ class Model(pl.LightningModule):
 
             ax.set_ylim((mu-3*sig, mu+3*sig))
             
-            for v in sample:
-                ax.plot(v)
+            # one collection per axis instead of a Line2D per channel,
+            # colored the same way successive `ax.plot` calls would be
+            segments: "C,L,2" = np.stack([ np.broadcast_to(np.arange(sample.shape[-1]), sample.shape), sample ], axis=-1)
+            colors = rcParams['axes.prop_cycle'].by_key()['color']
+            ax.add_collection(LineCollection(segments, colors=[ colors[i % len(colors)] for i in range(len(sample)) ]))
+            ax.autoscale_view()
 
-        self.logger.experiment.add_figure("samples", fig, global_step=self.global_step)
-        plt.close(fig)
+        self.logger.experiment.add_figure("samples", fig, global_step=global_step)
\ No newline at end of file
@@ -1,34 +1,61 @@
 # https://github.com/volkerp/fitCurves
 
-import numpy as np
+import math
+from functools import lru_cache
 
-import bezier
+import numpy as np
 
-def hodo(p: "N,2"):
-    return p.shape[0] * (p[1:] - p[:-1])
+from numba import njit
 
-def q(p: "4,2", t: "L,") -> "L,2":
-    """evaluates cubic bezier at t"""
-    return bezier.Curve.from_nodes(p.T).evaluate_multi(t).T
+jit = njit(cache=True, error_model='numpy')
 
-def qprime(p: "4,2", t: "L,") -> "L,2":
-    """evaluates cubic bezier first derivative at t"""
-    return bezier.Curve.from_nodes(hodo(p).T).evaluate_multi(t).T
+EPS = np.finfo(float).eps
 
-def qprimeprime(p: "4,2", t: "L,") -> "L,2":
-    """evaluates cubic bezier second derivative at t"""
-    return bezier.Curve.from_nodes(hodo(hodo(p)).T).evaluate_multi(t).T
+@jit
+def hodo(p: "N,2"):
+    return p.shape[0] * (p[1:] - p[:-1])
 
-def normalize(v):
-    magnitude = np.sqrt(np.dot(v,v))
-    if magnitude < np.finfo(float).eps:
+@jit
+def basis(t):
+    """
+    Bernstein basis of a cubic bezier and of its first and second hodographs at a single t.
+    shares the powers of t and 1-t between q, q' and q''
+    """
+    omt = 1 - t
+    omt2 = omt * omt
+    t2 = t * t
+    return (omt2 * omt, 3 * omt2 * t, 3 * omt * t2, t2 * t), (omt2, 2 * omt * t, t2), (omt, t)
+
+@jit
+def squared_errors(p: "4,2", points: "L,2", t: "L,", out: "L,") -> "L,":
+    """writes the squared distance between each point and the cubic bezier at t into `out`"""
+    for l in range(t.shape[0]):
+        B, _, _ = basis(t[l])
+        dx = B[0] * p[0,0] + B[1] * p[1,0] + B[2] * p[2,0] + B[3] * p[3,0] - points[l,0]
+        dy = B[0] * p[0,1] + B[1] * p[1,1] + B[2] * p[2,1] + B[3] * p[3,1] - points[l,1]
+        out[l] = dx * dx + dy * dy
+    return out
+
+@jit
+def normalize(v: "2,"):
+    magnitude = math.hypot(v[0], v[1])
+    if magnitude < EPS:
         return v
     return v / magnitude
 
-def fit_bezier(points: "L,2", max_err, left_tangent: "2," = None, right_tangent: "2," = None):
-    """fit one (ore more) Bezier curves to a set of points"""
+@lru_cache(maxsize=16)
+def tangent_weights(n: int, x: float = 2.) -> "N":
+    """geometrically decaying weights (summing to 1) used to estimate the end tangents from the first `n` neighbors"""
+    weights = (x**-np.arange(1,n+1)) / (1 - x**-n) * (x-1)
+    # shared between calls, so must not be modified
+    weights.setflags(write=False)
+    return weights
+
+def fit_bezier(points: "L,2", max_err, left_tangent: "2," = None, right_tangent: "2," = None) -> "M,4,2":
+    """fit one (ore more) Bezier curves to a set of points, returns the control points of each curve"""
     
-    weights: "N" = (lambda x,n: (float(x)**-np.arange(1,n+1)) / (1 - float(x)**-n) * (x-1))(2, min(10, len(points)-2))
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    weights: "N" = tangent_weights(min(10, len(points)-2))
     
     if left_tangent is None:
         # points[1] - points[0]
@@ -39,58 +66,119 @@ def fit_bezier(points: "L,2", max_err, left_tangent: "2," = None, right_tangent:
         # points[-2] - points[-1]
         r_vecs: "N,2" = points[-3:-3-len(weights):-1] - points[-2]
         right_tangent = normalize(np.einsum('np,n->p', r_vecs, weights))
+        
+    return fit_curves(
+        points, float(max_err),
+        np.asarray(left_tangent, dtype=np.float64),
+        np.asarray(right_tangent, dtype=np.float64),
+    )
+
+@jit
+def fit_curves(points: "L,2", max_err, left_tangent: "2,", right_tangent: "2,") -> "M,4,2":
+    """fit curves to a set of points using an explicit stack of segments and a single output buffer"""
+    
+    # segments only share endpoints, so there are at most L-1 of them
+    curves = np.empty((max(1, len(points)-1), 4, 2))
+    num_curves = 0
+    
+    # segments still to be fit, in reverse order so that curves come out left to right
+    stack = [(0, len(points)-1, left_tangent, right_tangent)]
+    while len(stack) > 0:
+        start, end, left_tangent, right_tangent = stack.pop()
+        seg = points[start:end+1]
+        bez_curve, split_point = fit_segment(seg, max_err, left_tangent, right_tangent)
+        
+        # only split at interior points, so that both halves are strictly shorter
+        if split_point < 1 or split_point > len(seg)-2:
+            curves[num_curves] = bez_curve
+            num_curves += 1
+            continue
+            
+        # Fitting failed -- split at max error point and fit both halves
+        center_tangent = normalize(seg[split_point-1] - seg[split_point+1])
+        stack.append((start+split_point, end, -center_tangent, right_tangent))
+        stack.append((start, start+split_point, left_tangent, center_tangent))
+        
+    return curves[:num_curves]
+
+@jit
+def fit_segment(points: "L,2", max_err, left_tangent: "2,", right_tangent: "2,"):
+    """
+    fit a single Bezier curve to a set of points.
+    returns `(bez_curve, -1)` on success, or `(bez_curve, split_point)` with the best fit found
+    if the points should be split
+    """
+    
+    # parameterize points
+    u = np.zeros(len(points))
+    u[1:] = np.cumsum(np.sqrt(np.sum((points[1:] - points[:-1]) ** 2, axis=1)))
     
-    # use heuristic if region only has two points in it
-    if len(points) == 2:
-        dist = np.linalg.norm(points[0] - points[1]) / 3.0
-        return [[
-            points[0],
-            points[0] + left_tangent * dist,
-            points[1] + right_tangent * dist,
-            points[1],
-        ]]
+    # use heuristic if region only has two points in it, or has zero length (can't be parameterized)
+    if len(points) <= 2 or u[-1] == 0:
+        dist = np.sqrt(np.sum((points[0] - points[-1]) ** 2)) / 3.0
+        bez_curve = np.empty((4,2))
+        bez_curve[0] = points[0]
+        bez_curve[1] = points[0] + left_tangent * dist
+        bez_curve[2] = points[-1] + right_tangent * dist
+        bez_curve[3] = points[-1]
+        return bez_curve, -1
+        
+    u /= u[-1]
     
-    u = None
-    for _ in range(32):
-        if u is None:
-            # parameterize points
-            u = [0]
-            u[1:] = np.cumsum(np.linalg.norm(points[1:] - points[:-1], axis=1))
-            u /= u[-1]
-        else:
+    bez_curve = np.empty((4,2))
+    errs = np.empty(len(points))
+    split_point = 0
+    for it in range(32):
+        if it > 0:
             # iterate parameterization
             u = newton_raphson_root_find(bez_curve, points, u)
             
         bez_curve = generate_bezier(points, u, left_tangent, right_tangent)
         
         # compute error
-        errs = ((q(bez_curve, u) - points) ** 2).sum(-1)
+        squared_errors(bez_curve, points, u, errs)
         split_point = errs.argmax()
         err = errs[split_point]
-            
-        if err < max_err:
-            return [bez_curve]
         
+        if err < max_err:
+            return bez_curve, -1
+            
         if err > max_err ** 2:
             # error too large
             break
+            
+    return bez_curve, split_point
 
-    # Fitting failed -- split at max error point and fit recursively
-    center_tangent = normalize(points[split_point-1] - points[split_point+1])
-    return [
-        *fit_bezier(points[:split_point+1], max_err, left_tangent, center_tangent),
-        *fit_bezier(points[split_point:], max_err, -center_tangent, right_tangent),
-    ]
-
+@jit
 def generate_bezier(points: "L,2", u: "L,", left_tangent: "2,", right_tangent: "2,"):
-    bez_curve: "4,2" = np.array([points[0], points[0], points[-1], points[-1]])
+    bez_curve: "4,2" = np.empty((4,2))
+    bez_curve[0] = bez_curve[1] = points[0]
+    bez_curve[2] = bez_curve[3] = points[-1]
 
-    # compute the A's
-    A = (3 * (1-u) * u * np.array([1-u,u])).T[..., None] * np.array([left_tangent, right_tangent])
-    
     # Create the C and X matrices
-    C = np.einsum('lix,ljx->ij', A, A)
-    X = np.einsum('lix,lx->i', A, points - q(bez_curve, u))
+    # A = [b1 * left_tangent, b2 * right_tangent] is never materialized,
+    # C and X are accumulated directly from the basis weights
+    b11 = b12 = b22 = x1 = x2 = 0.
+    for l in range(u.shape[0]):
+        B, _, _ = basis(u[l])
+        b1, b2 = B[1], B[2]
+        b11 += b1 * b1
+        b12 += b1 * b2
+        b22 += b2 * b2
+        
+        # residual against the curve with both inner control points on the ends
+        r0 = points[l,0] - (B[0] + B[1]) * points[0,0] - (B[2] + B[3]) * points[-1,0]
+        r1 = points[l,1] - (B[0] + B[1]) * points[0,1] - (B[2] + B[3]) * points[-1,1]
+        x1 += b1 * (r0 * left_tangent[0] + r1 * left_tangent[1])
+        x2 += b2 * (r0 * right_tangent[0] + r1 * right_tangent[1])
+        
+    C = np.empty((2,2))
+    C[0,0] = b11 * np.sum(left_tangent * left_tangent)
+    C[0,1] = C[1,0] = b12 * np.sum(left_tangent * right_tangent)
+    C[1,1] = b22 * np.sum(right_tangent * right_tangent)
+    X = np.empty(2)
+    X[0] = x1
+    X[1] = x2
 
     # Compute the determinants of C and X
     det_C0_C1 = C[0][0] * C[1][1] - C[1][0] * C[0][1]
@@ -104,7 +192,7 @@ def generate_bezier(points: "L,2", u: "L,", left_tangent: "2,", right_tangent: "
     # If alpha negative, use the Wu/Barsky heuristic (see text)
     # (if alpha is 0, you get coincident control points that lead to
     # divide by zero in any subsequent NewtonRaphsonRootFind() call)
-    seg_len = np.linalg.norm(points[0] - points[-1])
+    seg_len = np.sqrt(np.sum((points[0] - points[-1]) ** 2))
     epsilon = 1e-6 * seg_len
     if alpha_l < epsilon or alpha_r < epsilon:
         # fall back on standard (probably inaccurate) formula, and subdivide further if needed.
@@ -122,6 +210,7 @@ def generate_bezier(points: "L,2", u: "L,", left_tangent: "2,", right_tangent: "
     return bez_curve
 
 
+@jit
 def newton_raphson_root_find(bez: "4,2", points: "L,2", u: "L,"):
     """
     Newton's root finding algorithm calculates f(x)=0 by reiterating
@@ -137,9 +226,20 @@ def newton_raphson_root_find(bez: "4,2", points: "L,2", u: "L,"):
     u_n+1 = u_n - |q(u_n)-p * q'(u_n)| / |q'(u_n)**2 + q(u_n)-p * q''(u_n)|
     """
     
-    d = q(bez, u) - points
-    qp = qprime(bez, u)
-    num = (d * qp).sum(-1)
-    den = (qp**2 + d*qprimeprime(bez, u)).sum(-1)
+    h1 = hodo(bez)
+    h2 = hodo(h1)
     
-    return u + np.where(den==0, 0, num/den)
\ No newline at end of file
+    # q, q' and q'' are evaluated together from one basis per point
+    u_next = np.empty_like(u)
+    for l in range(u.shape[0]):
+        B, dB, ddB = basis(u[l])
+        num = den = 0.
+        for i in range(2):
+            d = B[0] * bez[0,i] + B[1] * bez[1,i] + B[2] * bez[2,i] + B[3] * bez[3,i] - points[l,i]
+            qp = dB[0] * h1[0,i] + dB[1] * h1[1,i] + dB[2] * h1[2,i]
+            qpp = ddB[0] * h2[0,i] + ddB[1] * h2[1,i]
+            num += d * qp
+            den += qp**2 + d * qpp
+        u_next[l] = u[l] + (0. if den == 0 else num / den)
+        
+    return u_next
\ No newline at end of file
@@ -117,8 +117,8 @@ def to_slider_decoder(frame_times, cursor_signal, slider_signal):
             seg_type = np.mean(seg_type_sig[seg_start:seg_end+1])
             if seg_type > 0:
                 # bezier
-                for b in fit_bezier(cursor_signal.T[seg_start:seg_end+1], max_err=100):
-                    b = np.array(b).round().astype(int)
+                curves: "M,4,2" = fit_bezier(cursor_signal.T[seg_start:seg_end+1], max_err=100).round().astype(int)
+                for b in curves:
                     ctrl_pts.extend(b)
                     length += bezier.Curve.from_nodes(b.T).length
             else:
@@ -37,6 +37,8 @@ if __name__ == "__main__":
     model_args = parser.add_argument_group('model arguments')
     model_args.add_argument('--sample_steps', type=int, default=128, help='number of steps to sample')
     model_args.add_argument('--num_samples', type=int, default=3, help='number of maps to generate')
+    model_args.add_argument('--compile_net', action='store_true',
+        help='compile the model with `torch.compile` (requires torch>=2.0) - speeds up sampling at the cost of an upfront compile')
     
     timing_args = parser.add_argument_group('timing arguments')
     timing_args.add_argument('--bpm', type=float,
@@ -81,9 +83,14 @@ if __name__ == "__main__":
             
     # load model
     # ======
+    hparams = dict(sample_steps=args.sample_steps)
+    if args.compile_net:
+        # otherwise keep the setting the model was trained with
+        hparams['compile_net'] = True
+        
     model = Model.load_from_checkpoint(
         args.model_path,
-        sample_steps=args.sample_steps,
+        **hparams,
     ).eval()
     
     if torch.cuda.is_available():
@@ -13,6 +13,7 @@ setup(
     install_requires=[
         "bezier",
         "librosa",
+        "numba",
         "tqdm",
         "torch",
         "torchaudio",